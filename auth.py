@@ -7,13 +7,26 @@ from starlette import status
 from passlib.context import CryptContext
 from jose import jwt, JWTError
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, Column, String, Integer, DateTime
-from sqlalchemy.orm import declarative_base, sessionmaker, Session
+from sqlalchemy import Column, String, Integer, DateTime, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from cachetools import TTLCache
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+import msgpack
+import hashlib
+import math
+import logging
+import threading
 import os
 import time
 
 load_dotenv()
 
+log = logging.getLogger(__name__)
+
 # Define IST timezone (UTC+5:30)
 IST = timezone(timedelta(hours=5, minutes=30))
 
@@ -26,16 +39,63 @@ SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM")
 EXPIRATION_TIME = 30
 
-# Database connection
+if not SECRET_KEY or not ALGORITHM:
+    raise RuntimeError("SECRET_KEY and ALGORITHM must be set")
+
+# Built once and reused by every jwt.decode call
+_ALGS = (ALGORITHM,)
+_DECODE_OPTS = {"require_exp": True, "require_sub": True}
+MAX_TOKEN_LENGTH = 4096
+
+# Database connection (async, asyncpg driver)
 POSTGRES_URI = os.getenv("postgres_uri")
-engine = create_engine(POSTGRES_URI)
-SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
+engine = create_async_engine(
+    make_url(POSTGRES_URI).set(drivername="postgresql+asyncpg"),
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=int(os.getenv("DB_POOL_SIZE", "20")),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "10")),
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    pool_timeout=10,
+)
+SessionLocal = async_sessionmaker(engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 # Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# New hashes use argon2id (time_cost=2, 19 MiB, parallelism=1). bcrypt is kept
+# only to verify legacy hashes, which are rehashed on the next successful login.
+pwd_context = CryptContext(
+    schemes=["argon2", "bcrypt"],
+    deprecated=["bcrypt"],
+    argon2__type="ID",
+    argon2__time_cost=2,
+    argon2__memory_cost=19456,
+    argon2__parallelism=1,
+)
 oauth2_Bearer = OAuth2PasswordBearer(tokenUrl='auth/login')
 
+# Verified token cache: blake2b(token) -> (user_id, username, email, valid_until)
+# valid_until = min(token exp, time the user was resolved + 60s); it is fixed
+# when the token is first verified and carried unchanged through Redis, so an
+# entry is never trusted for longer than 60s after the DB lookup.
+# With REDIS_URL set, entries are also shared across workers via Redis.
+JWT_CACHE_TTL = 60
+JWT_CACHE_MAXSIZE = int(os.getenv("JWT_CACHE_MAXSIZE", "10000"))
+_jwt_cache = TTLCache(maxsize=JWT_CACHE_MAXSIZE, ttl=JWT_CACHE_TTL)
+_jwt_cache_lock = threading.Lock()
+REDIS_URL = os.getenv("REDIS_URL")
+# Short timeouts so an unreachable Redis degrades to the direct path quickly
+_redis = Redis.from_url(
+    REDIS_URL,
+    socket_connect_timeout=0.1,
+    socket_timeout=0.1,
+    retry_on_timeout=False,
+) if REDIS_URL else None
+# After a Redis error, skip Redis for this many seconds instead of paying the
+# timeouts on every request; the failure is logged once per window
+REDIS_BACKOFF_SECONDS = 10
+_redis_retry_at = 0.0
+
 # Database model
 class User(Base):
     __tablename__ = "user"
@@ -45,8 +105,6 @@ class User(Base):
     password = Column(String, nullable=False)
     created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(IST))
 
-Base.metadata.create_all(bind=engine)
-
 class UserRegistration(BaseModel):
     username: str
     email: str
@@ -57,18 +115,24 @@ class UserLogin(BaseModel):
     access_token: str
     token_type: str
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 def hash_password(password: str) -> str:
     return pwd_context.hash(password)
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+def verify_password(plain_password: str, hashed_password: str) -> tuple[bool, str | None]:
+    """Return (ok, new_hash); new_hash is set when the stored hash needs upgrading"""
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+def benchmark_password_hashing() -> float:
+    """Hash a dummy password once and report the cost in ms/op"""
+    start = time.perf_counter()
+    pwd_context.hash("time-capsule-benchmark")
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    log.info("Password hashing: %s, %.1f ms/op", pwd_context.default_scheme(), elapsed_ms)
+    return elapsed_ms
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None) -> str:
     to_encode = data.copy()
@@ -76,13 +140,108 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None) -> s
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
-def get_user_by_username(db: Session, username: str):
-    return db.query(User).filter(User.username == username).first()
+async def get_user_by_username(db: AsyncSession, username: str):
+    result = await db.execute(select(User).where(User.username == username))
+    return result.scalar_one_or_none()
+
+def _token_key(token: str) -> bytes:
+    return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+def _get_cached_user(key: bytes):
+    with _jwt_cache_lock:
+        entry = _jwt_cache.get(key)
+    if entry is None:
+        return None
+    user_id, username, email, valid_until = entry
+    if valid_until <= time.time():
+        with _jwt_cache_lock:
+            _jwt_cache.pop(key, None)
+        return None
+    # Detached User carrying only the cached columns; no DB access needed
+    return User(id=user_id, username=username, email=email)
+
+def _cache_user(key: bytes, user: User, valid_until: float):
+    with _jwt_cache_lock:
+        _jwt_cache[key] = (user.id, user.username, user.email, valid_until)
+
+def _is_valid_entry(user_id, username, email, valid_until) -> bool:
+    """Check field types of an entry read back from Redis"""
+    return (
+        isinstance(user_id, int) and not isinstance(user_id, bool)
+        and isinstance(username, str)
+        and isinstance(email, str)
+        and isinstance(valid_until, (int, float)) and not isinstance(valid_until, bool)
+    )
+
+def _redis_available() -> bool:
+    return _redis is not None and time.monotonic() >= _redis_retry_at
+
+def _redis_failed():
+    global _redis_retry_at
+    now = time.monotonic()
+    # Concurrent requests failing in the same window only log once
+    if now >= _redis_retry_at:
+        log.warning(
+            "Redis unavailable, skipping shared token cache for %ds",
+            REDIS_BACKOFF_SECONDS,
+            exc_info=True,
+        )
+    _redis_retry_at = now + REDIS_BACKOFF_SECONDS
+
+async def _get_shared_user(key: bytes):
+    """Look the token up in Redis and copy a hit into the local cache"""
+    if not _redis_available():
+        return None
+    try:
+        raw = await _redis.get(b"jwt:" + key.hex().encode())
+    except RedisError:
+        _redis_failed()
+        return None
+    if raw is None:
+        return None
+    try:
+        user_id, username, email, valid_until = msgpack.unpackb(raw)
+    except (ValueError, TypeError, msgpack.exceptions.ExtraData):
+        # Corrupt or foreign value under jwt:*; treat it as a miss
+        return None
+    if not _is_valid_entry(user_id, username, email, valid_until):
+        return None
+    # Keep the original valid_until so the copy doesn't restart the clock
+    with _jwt_cache_lock:
+        _jwt_cache[key] = (user_id, username, email, valid_until)
+    return _get_cached_user(key)
+
+async def _store_shared_user(key: bytes, user: User, valid_until: float):
+    if not _redis_available():
+        return
+    ttl = math.ceil(valid_until - time.time())
+    if ttl <= 0:
+        return
+    value = msgpack.packb((user.id, user.username, user.email, valid_until))
+    try:
+        await _redis.setex(b"jwt:" + key.hex().encode(), ttl, value)
+    except RedisError:
+        _redis_failed()
+
+async def close_shared_cache():
+    """Close the Redis connection pool, if one was configured"""
+    if _redis is not None:
+        await _redis.aclose()
+
+def _is_plausible_token(token: str) -> bool:
+    """Cheap structural checks that reject garbage before any HMAC work"""
+    if len(token) > MAX_TOKEN_LENGTH or token.count(".") != 2:
+        return False
+    try:
+        # Header is only parsed here, not trusted; decode still verifies it
+        return jwt.get_unverified_header(token).get("alg") == ALGORITHM
+    except JWTError:
+        return False
 
 # Routes
 @route.post("/register", status_code=status.HTTP_201_CREATED)
-async def register_user(user: UserRegistration, db: Session = Depends(get_db)):
-    if get_user_by_username(db, user.username):
+async def register_user(user: UserRegistration, db: AsyncSession = Depends(get_db)):
+    if await get_user_by_username(db, user.username):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Username already exists")
     if user.confirm_password != user.password:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Passwords do not match")
@@ -90,36 +249,56 @@ async def register_user(user: UserRegistration, db: Session = Depends(get_db)):
     hashed_password = hash_password(user.password)
     new_user = User(username=user.username, email=user.email, password=hashed_password)
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
 
     return {"message": "User registered successfully"}
 
 
 #login
 @route.post("/login", response_model=UserLogin)
-async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db: Session = Depends(get_db)):
-    user = get_user_by_username(db, form_data.username)
-    if not user or not verify_password(form_data.password, user.password):
+async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db: AsyncSession = Depends(get_db)):
+    user = await get_user_by_username(db, form_data.username)
+    verified, new_hash = verify_password(form_data.password, user.password) if user else (False, None)
+    if not verified:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    # Rehash on login when the stored hash is bcrypt or uses outdated parameters
+    if new_hash:
+        user.password = new_hash
+        await db.commit()
     access_token = create_access_token(data={"sub": user.username})
     return {"access_token": access_token, "token_type": "bearer"}
 
 #authorization
-@route.get("/me")
-async def get_current_user(token: Annotated[str, Depends(oauth2_Bearer)], db: Session = Depends(get_db)):
+async def get_current_user(token: Annotated[str, Depends(oauth2_Bearer)], db: AsyncSession = Depends(get_db)) -> User:
+    key = _token_key(token)
+    cached = _get_cached_user(key)
+    if cached is not None:
+        return cached
+    if not _is_plausible_token(token):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+    cached = await _get_shared_user(key)
+    if cached is not None:
+        return cached
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, SECRET_KEY, algorithms=_ALGS, options=_DECODE_OPTS)
         username: str = payload.get("sub")
         if username is None:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
-        user = get_user_by_username(db, username)
+        user = await get_user_by_username(db, username)
         if user is None:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
-        return {"username": user.username, "email": user.email}
+        valid_until = min(float(payload["exp"]), time.time() + JWT_CACHE_TTL)
+        _cache_user(key, user, valid_until)
+        await _store_shared_user(key, user, valid_until)
+        return user
     except JWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+
+@route.get("/me")
+async def read_current_user(current_user: Annotated[User, Depends(get_current_user)]):
+    return {"username": current_user.username, "email": current_user.email}
+
@@ -1,16 +1,53 @@
 from fastapi import FastAPI, Depends, HTTPException, Query, BackgroundTasks
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, Boolean
-from sqlalchemy.orm import relationship, Session
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, Boolean, Index, text, select, insert, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import relationship
 from datetime import datetime, timedelta, timezone
-from typing import Dict, Any, List, Optional
+from typing import List, Optional
 from pydantic import BaseModel
+import hmac
 import secrets
-import string
 import asyncio
-from auth import route as auth_router, Base, engine, get_db, User, get_current_user, IST
+import os
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from auth import route as auth_router, Base, engine, get_db, SessionLocal, User, get_current_user, IST, benchmark_password_hashing, close_shared_cache
 
 app = FastAPI(title="Time-Capsule")
 
+log = logging.getLogger(__name__)
+
+# Records are handed to a queue and written to stderr by a listener thread,
+# so logging never blocks the event loop. Only this app's loggers are
+# configured; library and root logger settings are left alone.
+APP_LOGGERS = ("auth", __name__)
+_log_queue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+_log_listener = QueueListener(_log_queue, _log_handler)
+_logging_configured = False
+
+def configure_logging():
+    """Attach the queue handler once; start the listener for this app lifespan"""
+    global _logging_configured
+    if not _logging_configured:
+        queue_handler = QueueHandler(_log_queue)
+        for name in APP_LOGGERS:
+            app_log = logging.getLogger(name)
+            app_log.addHandler(queue_handler)
+            app_log.setLevel(logging.INFO)
+            app_log.propagate = False
+        _logging_configured = True
+    _log_listener.start()
+
+# Create missing tables on startup only when explicitly enabled (RUN_MIGRATIONS=1);
+# production schemas should be managed with migrations instead
+RUN_MIGRATIONS = os.getenv("RUN_MIGRATIONS") == "1"
+
+_expiration_task = None
+
 app.include_router(auth_router)
 
 # Capsule model with expiration flag
@@ -18,17 +55,22 @@ class Capsule(Base):
     __tablename__ = "capsules"
     id = Column(Integer, primary_key=True, index=True)
     message = Column(Text, nullable=False)
-    unlock_at = Column(DateTime, nullable=False) 
-    created_at = Column(DateTime, default=lambda: datetime.now(IST)) 
+    unlock_at = Column(DateTime(timezone=True), nullable=False) 
+    created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(IST)) 
     unlock_code = Column(String(12), nullable=False, unique=True)
     user_id = Column(Integer, ForeignKey("user.id"))
     expired = Column(Boolean, default=False)  # New column for expiration status
 
     user = relationship("User", back_populates="capsules")
 
-User.capsules = relationship("Capsule", back_populates="user")
+    __table_args__ = (
+        # Serves list_capsules: filter by owner, newest first (keyset on id)
+        Index("ix_capsules_user_id_desc", "user_id", id.desc()),
+        # Serves the expiration UPDATE: expired = false AND unlock_at < threshold
+        Index("ix_capsules_unexpired_unlock_at", "unlock_at", postgresql_where=text("NOT expired")),
+    )
 
-Base.metadata.create_all(bind=engine)
+User.capsules = relationship("Capsule", back_populates="user")
 
 # Pydantic models
 class CapsuleCreate(BaseModel):
@@ -74,14 +116,22 @@ class CapsuleListItem(BaseModel):
         
 class CapsuleListResponse(BaseModel):
     capsules: List[CapsuleListItem]
-    total: int
+    total: Optional[int] = None
     page: int
     limit: int
-    total_pages: int
+    total_pages: Optional[int] = None
+    has_more: bool
+    next_cursor: Optional[int] = None
     
     class Config:
         from_attributes = True
 
+# Request-scoped wall clock: one datetime.now(IST) per request, shared by
+# every check in the endpoint. async so FastAPI calls it inline instead of
+# handing it to the threadpool.
+async def now_ist() -> datetime:
+    return datetime.now(IST)
+
 # Helper function to ensure datetime is timezone-aware with IST
 def ensure_timezone_aware(dt):
     """Ensure datetime is timezone-aware with IST timezone"""
@@ -91,43 +141,57 @@ def ensure_timezone_aware(dt):
         return dt.astimezone(IST)
     return dt
 
-# Generate unlock code
+# Generate unlock code (base64url: letters, digits, '-' and '_'; 72 bits for length 12)
 def generate_unlock_code(length=12):
-    alphabet = string.ascii_letters + string.digits
-    return ''.join(secrets.choice(alphabet) for _ in range(length))
+    return secrets.token_urlsafe((length * 3 + 3) // 4)[:length]
+
+UNLOCK_CODE_ATTEMPTS = 3
+# Postgres' default name for the UNIQUE constraint on capsules.unlock_code
+UNLOCK_CODE_CONSTRAINT = "capsules_unlock_code_key"
+
+def is_unlock_code_collision(exc: IntegrityError) -> bool:
+    """True when the INSERT failed on the unique unlock_code constraint"""
+    # asyncpg's UniqueViolationError is chained behind the DBAPI error
+    cause = exc.orig.__cause__
+    if getattr(cause, "sqlstate", None) != "23505":
+        return False
+    return getattr(cause, "constraint_name", None) == UNLOCK_CODE_CONSTRAINT
 
 # Background expiration task
+async def expire_capsules(current_time: datetime):
+    """
+    Run one expiration pass in its own session.
+    A capsule is considered expired when current_time > unlock_at + 30 days.
+    The session is rolled back if needed and closed (returning its connection
+    to the pool) on exit.
+    """
+    async with SessionLocal() as db:
+        # unlock_at + 30 days < current_time  <=>  unlock_at < threshold,
+        # so the comparison is a plain range predicate on the column
+        threshold = current_time - timedelta(days=30)
+        
+        # Mark every overdue capsule expired in a single UPDATE
+        result = await db.execute(
+            update(Capsule)
+            .where(Capsule.expired == False, Capsule.unlock_at < threshold)
+            .values(expired=True)
+        )
+        await db.commit()
+        
+        if result.rowcount:
+            log.info("Marked %d capsules as expired", result.rowcount)
+
 async def check_expirations():
     """
     Background task that runs every hour to check for expired capsules.
-    A capsule is considered expired when current_time > unlock_at + 30 days.
+    No connection is held while sleeping between passes.
     """
     while True:
+        # One failed pass must not stop expiration for the life of the process
         try:
-            db = next(get_db())
-            current_time = datetime.now(IST)
-            
-            # Find capsules that need to be marked as expired
-            # (unlock_at + 30 days < current_time AND not already marked expired)
-            expired_capsules = db.query(Capsule).filter(
-                Capsule.expired == False
-            ).all()
-            
-            # Mark as expired if needed
-            for capsule in expired_capsules:
-                unlock_at = ensure_timezone_aware(capsule.unlock_at)
-                if unlock_at + timedelta(days=30) < current_time:
-                    capsule.expired = True
-            
-            # Commit changes if any capsules were updated
-            if expired_capsules:
-                db.commit()
-                print(f"Checked {len(expired_capsules)} capsules for expiration")
-                
-        except Exception as e:
-            print(f"Error in expiration check: {e}")
-        finally:
-            db.close()
+            await expire_capsules(datetime.now(IST))
+        except Exception:
+            log.exception("Error in expiration check")
         
         # Run every hour (3600 seconds)
         await asyncio.sleep(3600)
@@ -136,41 +200,56 @@ async def check_expirations():
 def welcome():
     return {"This is Time-Capsule"}
 
+@app.get("/health/db")
+async def health_db(db: AsyncSession = Depends(get_db)):
+    """Run SELECT 1 so orchestrators can detect an unreachable DB or exhausted pool"""
+    try:
+        await db.execute(text("SELECT 1"))
+    except Exception:
+        raise HTTPException(status_code=503, detail="Database unavailable")
+    return {"status": "ok"}
+
 @app.post("/capsules", response_model=CapsuleResponse)
 async def create_capsule(
     capsule: CapsuleCreate,
-    db: Session = Depends(get_db),
-    current_user: Dict[str, Any] = Depends(get_current_user)
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+    current_time: datetime = Depends(now_ist)
 ):
-    username = current_user["username"]
-    user = db.query(User).filter(User.username == username).first()
-
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-
     # Ensure timezone awareness
     unlock_at = ensure_timezone_aware(capsule.unlock_at)
     
     # Check if unlock time is in the future
-    if unlock_at <= datetime.now(IST):
+    if unlock_at <= current_time:
         raise HTTPException(
             status_code=400,
             detail="Unlock time must be in the future"
         )
 
-    unlock_code = generate_unlock_code()
-
-    new_capsule = Capsule(
-        message=capsule.message,
-        unlock_at=unlock_at,
-        unlock_code=unlock_code,
-        user_id=user.id,
-        expired=False
-    )
-
-    db.add(new_capsule)
-    db.commit()
-    db.refresh(new_capsule)
+    # Read before any rollback: a rollback expires current_user, and lazy
+    # loading it afterwards is not possible on an AsyncSession
+    user_id = current_user.id
+
+    # Uniqueness is enforced by the DB; regenerate on the (very rare) collision
+    for attempt in range(UNLOCK_CODE_ATTEMPTS):
+        # INSERT ... RETURNING gives back the new row in the same round trip
+        stmt = insert(Capsule).values(
+            message=capsule.message,
+            unlock_at=unlock_at,
+            unlock_code=generate_unlock_code(),
+            user_id=user_id,
+            expired=False
+        ).returning(Capsule.id, Capsule.unlock_code, Capsule.unlock_at)
+        try:
+            new_capsule = (await db.execute(stmt)).one()
+            await db.commit()
+            break
+        except IntegrityError as e:
+            await db.rollback()
+            if not is_unlock_code_collision(e):
+                raise
+            if attempt == UNLOCK_CODE_ATTEMPTS - 1:
+                raise HTTPException(status_code=500, detail="Could not generate a unique unlock code")
 
     return {
         "id": new_capsule.id,
@@ -183,40 +262,53 @@ async def create_capsule(
 async def list_capsules(
     page: int = Query(1, ge=1, description="Page number"),
     limit: int = Query(10, ge=1, le=100, description="Items per page"),
-    db: Session = Depends(get_db),
-    current_user: Dict[str, Any] = Depends(get_current_user)
+    cursor: Optional[int] = Query(None, description="next_cursor from the previous page; takes precedence over page"),
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+    current_time: datetime = Depends(now_ist)
 ):
-    username = current_user["username"]
-    user = db.query(User).filter(User.username == username).first()
-    
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    total_capsules = db.query(Capsule).filter(Capsule.user_id == user.id).count()
-    total_pages = (total_capsules + limit - 1) // limit
+    # Newest first; ids are assigned in creation order. Only the listed
+    # columns are fetched so large messages never leave the database.
+    query = select(
+        Capsule.id,
+        Capsule.unlock_code,
+        Capsule.unlock_at,
+        Capsule.created_at,
+        Capsule.expired
+    ).where(Capsule.user_id == current_user.id)\
+        .order_by(Capsule.id.desc())\
+        .limit(limit + 1)
+    if cursor is not None:
+        # Keyset pagination: an index range scan regardless of depth
+        query = query.where(Capsule.id < cursor)
+    else:
+        query = query.offset((page - 1) * limit)
     
-    capsules = db.query(Capsule).filter(Capsule.user_id == user.id)\
-        .order_by(Capsule.created_at.desc())\
-        .offset((page - 1) * limit)\
-        .limit(limit)\
-        .all()
+    result = await db.execute(query)
+    capsules = result.all()
+    # One extra row tells us whether another page exists without a COUNT(*)
+    has_more = len(capsules) > limit
+    capsules = capsules[:limit]
+    next_cursor = capsules[-1].id if has_more else None
     
-    current_time = datetime.now(IST)
+    # unlock_at comes back timezone-aware, so compare against values computed once
+    threshold = current_time - timedelta(days=30)
     
     capsule_list = []
+    to_expire = []
     for capsule in capsules:
-        # Make sure unlock_at is timezone-aware
-        unlock_at = ensure_timezone_aware(capsule.unlock_at)
+        unlock_at = capsule.unlock_at
         
         # Update is_unlockable logic to consider expiration
-        is_unlockable = (current_time >= unlock_at and 
-                        current_time <= unlock_at + timedelta(days=30) and
+        is_unlockable = (unlock_at <= current_time and 
+                        unlock_at >= threshold and
                         not capsule.expired)
         
-        # Check if it should be marked as expired now
-        if not capsule.expired and current_time > unlock_at + timedelta(days=30):
-            capsule.expired = True
-            db.commit()
+        # Collect capsules that should be marked as expired now
+        expired = capsule.expired
+        if not expired and unlock_at < threshold:
+            to_expire.append(capsule.id)
+            expired = True
         
         capsule_list.append({
             "id": capsule.id,
@@ -224,15 +316,24 @@ async def list_capsules(
             "unlock_at": capsule.unlock_at,
             "created_at": capsule.created_at,
             "is_unlockable": is_unlockable,
-            "expired": capsule.expired
+            "expired": expired
         })
     
+    # Persist all newly expired capsules on this page in one UPDATE
+    if to_expire:
+        await db.execute(
+            update(Capsule).where(Capsule.id.in_(to_expire)).values(expired=True)
+        )
+        await db.commit()
+    
     return {
         "capsules": capsule_list,
-        "total": total_capsules,
+        "total": None,
         "page": page,
         "limit": limit,
-        "total_pages": total_pages
+        "total_pages": None,
+        "has_more": has_more,
+        "next_cursor": next_cursor
     }
 
 @app.put("/capsules/{capsule_id}", response_model=CapsuleUpdateRespone)
@@ -240,30 +341,24 @@ async def update_capsule(
     capsule_id: int,
     capsule_update: CapsuleUpdate,
     code: str = Query(..., description="Unlock code for the capsule"),
-    db: Session = Depends(get_db),
-    current_user: Dict[str, Any] = Depends(get_current_user)
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+    current_time: datetime = Depends(now_ist)
 ):
-    username = current_user["username"]
-    user = db.query(User).filter(User.username == username).first()
-    
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    capsule = db.query(Capsule).filter(
+    result = await db.execute(select(Capsule).where(
         Capsule.id == capsule_id
-    ).first()
+    ))
+    capsule = result.scalar_one_or_none()
     
     if not capsule:
         raise HTTPException(status_code=404, detail="Capsule not found")
     
-    if capsule.user_id != user.id:
+    if capsule.user_id != current_user.id:
         raise HTTPException(status_code=403, detail="403 forbidden")
     
-    if capsule.unlock_code != code:
+    if not hmac.compare_digest(capsule.unlock_code.encode(), code.encode()):
         raise HTTPException(status_code=401, detail="401 unauthorized")
     
-    current_time = datetime.now(IST)
-    
     # Ensure capsule.unlock_at is timezone-aware
     unlock_at = ensure_timezone_aware(capsule.unlock_at)
     
@@ -287,8 +382,8 @@ async def update_capsule(
             
         capsule.unlock_at = new_unlock_at
     
-    db.commit()
-    db.refresh(capsule)
+    await db.commit()
+    await db.refresh(capsule)
     
     return {
         "message": capsule.message,
@@ -300,19 +395,19 @@ async def update_capsule(
 async def get_capsule(
     capsule_id: int,
     code: str = Query(..., description="Unlock code for the capsule"),
-    db: Session = Depends(get_db),
-    current_user: Dict[str, Any] = Depends(get_current_user)
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+    current_time: datetime = Depends(now_ist)
 ):
-    capsule = db.query(Capsule).filter(Capsule.id == capsule_id).first()
+    result = await db.execute(select(Capsule).where(Capsule.id == capsule_id))
+    capsule = result.scalar_one_or_none()
 
     if not capsule:
         raise HTTPException(status_code=404, detail="Capsule not found")
 
-    if capsule.unlock_code != code:
+    if not hmac.compare_digest(capsule.unlock_code.encode(), code.encode()):
         raise HTTPException(status_code=401, detail="401 unauthorized")
 
-    current_time = datetime.now(IST)
-    
     # Ensure capsule.unlock_at is timezone-aware
     unlock_at = ensure_timezone_aware(capsule.unlock_at)
 
@@ -327,7 +422,7 @@ async def get_capsule(
         # If not marked as expired but should be, mark it now
         if not capsule.expired and current_time > unlock_at + timedelta(days=30):
             capsule.expired = True
-            db.commit()
+            await db.commit()
             
         raise HTTPException(
             status_code=410,
@@ -340,28 +435,22 @@ async def get_capsule(
 async def delete_capsule(
     capsule_id: int,
     code: str = Query(..., description="Unlock code for Capsule"),
-    db: Session = Depends(get_db),
-    current_user: Dict[str, Any] = Depends(get_current_user)
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+    current_time: datetime = Depends(now_ist)
 ):
-    username = current_user["username"]
-    user = db.query(User).filter(User.username == username).first()
-    
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    capsule = db.query(Capsule).filter(Capsule.id == capsule_id).first()
+    result = await db.execute(select(Capsule).where(Capsule.id == capsule_id))
+    capsule = result.scalar_one_or_none()
 
     if not capsule:
         raise HTTPException(status_code=404, detail="Capsule not found")
     
-    if capsule.user_id != user.id:
+    if capsule.user_id != current_user.id:
         raise HTTPException(status_code=403, detail="403 forbidden")
     
-    if capsule.unlock_code != code:
+    if not hmac.compare_digest(capsule.unlock_code.encode(), code.encode()):
         raise HTTPException(status_code=401, detail="401 unauthorized")
     
-    current_time = datetime.now(IST)
-    
     # Ensure capsule.unlock_at is timezone-aware
     unlock_at = ensure_timezone_aware(capsule.unlock_at)
     
@@ -371,8 +460,8 @@ async def delete_capsule(
             detail="403 forbidden (Cannot delete capsule after unlock time)"
         )
     
-    db.delete(capsule)
-    db.commit()
+    await db.delete(capsule)
+    await db.commit()
     
     return {"detail": "Capsule deleted successfully"}
 
@@ -382,5 +471,22 @@ async def startup_event():
     """
     Register the hourly expiration check task when the application starts.
     This ensures we regularly mark expired capsules without checking on every request.
+    Also times one password hash so operators can tune the hashing cost.
     """
-    asyncio.create_task(check_expirations())
+    configure_logging()
+    if RUN_MIGRATIONS:
+        # create_all is sync-only, so run it on the async connection via run_sync
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+    benchmark_password_hashing()
+    # Keep a reference so the task isn't garbage collected mid-run
+    global _expiration_task
+    _expiration_task = asyncio.create_task(check_expirations())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop the expiration task, close the shared token cache and flush queued log records."""
+    if _expiration_task is not None:
+        _expiration_task.cancel()
+    await close_shared_cache()
+    _log_listener.stop()